@@ -7,7 +7,7 @@ import monai
 from monai.data import DataLoader
 from test_utils import TEST_CONFIG_SEGM
 
-from trainlib.data import dataloaders, import_dataset
+from trainlib.data import ThreadDataLoader, dataloaders, import_dataset
 
 
 class TestDatasetInit(unittest.TestCase):
@@ -30,6 +30,12 @@ class TestDatasetInit(unittest.TestCase):
             self.assertTrue(Path(self.config.data.cache_dir).exists())
         self.assertIsInstance(dataset, monai.data.PersistentDataset)
 
+    def test_init_cache_dataset(self):
+        """Test that dataset is of correct instance"""
+        self.config.data.dataset_type = "cache"
+        dataset = import_dataset(self.config)(data=[], transform=[])
+        self.assertIsInstance(dataset, monai.data.CacheDataset)
+
 
 class TestSegmentationDataLoaders(unittest.TestCase):
     config = TEST_CONFIG_SEGM
@@ -47,6 +53,13 @@ class TestSegmentationDataLoaders(unittest.TestCase):
         self.assertIsInstance(segmentation_dataloaders[0], DataLoader)
         self.assertIsInstance(segmentation_dataloaders[1], DataLoader)
 
+    def test_thread_dataloader(self):
+        self.config.data.dataloader_type = "thread"
+        segmentation_dataloaders = dataloaders(self.config)
+        self.config.data.dataloader_type = "default"
+        self.assertIsInstance(segmentation_dataloaders[0], ThreadDataLoader)
+        self.assertTrue(hasattr(segmentation_dataloaders[0], "sanity_check"))
+
     def test_show_batch(self):
         segmentation_dataloaders = dataloaders(self.config)
         self.assertTrue(hasattr(segmentation_dataloaders[0], "show_batch"))
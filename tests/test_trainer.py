@@ -65,6 +65,25 @@ class TestSegmentationTrainer3d(unittest.TestCase):
             raise AssertionError(f"{fn} exists but does not point towards a file.")
 
 
+class TestSegmentationPredict(unittest.TestCase):
+    config = deepcopy(TEST_CONFIG_SEGM)
+    config.data.dataset_type = "cache"
+    config.transforms.base.Spacingd.allow_missing_keys = True  # no label for prediction
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.config.run_id.split("/")[0], ignore_errors=True)
+        shutil.rmtree(self.config.model_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_predict_cache_dataset(self):
+        """Test that the given file is predicted, not a cached item of the test data"""
+        trainer = SegmentationTrainer(config=self.config)
+        trainer.config.data.train = trainer.config.data.valid = False  # only build the test DataLoader
+        fn = "../data/images/radiopaedia_29_86490_1.nii.gz"
+        out = trainer.predict(fn)
+        self.assertEqual(Path(out["image"].meta["filename_or_obj"][0]).name, Path(fn).name)
+
+
 class TestSegmentationTrainer2d(unittest.TestCase):
     config = deepcopy(TEST_CONFIG_SEGM)
     config.data.train_csv = "../data/test_data_valid_2d_segm.csv"
@@ -4,8 +4,9 @@ import unittest
 from pathlib import Path
 
 import munch
+import torch
 
-from trainlib.utils import import_patched, load_config, num_workers
+from trainlib.utils import get_memory_format, import_patched, load_config, num_workers
 
 
 class TestNumWorkers(unittest.TestCase):
@@ -62,5 +63,19 @@ class TestImportPatched(unittest.TestCase):
         self.assertEqual(return_five(), 6)
 
 
+class TestGetMemoryFormat(unittest.TestCase):
+    def test_memory_format(self):
+        """Test that channels last memory format matches the image dimensions"""
+        config = load_config("test_config_segm.yaml")
+        self.assertIsNone(get_memory_format(config))
+        config.transforms.channel_layout = "channels_last"
+        self.assertEqual(get_memory_format(config), torch.channels_last_3d)
+        config.ndim = 2
+        self.assertEqual(get_memory_format(config), torch.channels_last)
+        config.transforms.channel_layout = "aosoa"
+        with self.assertRaises(ValueError):
+            get_memory_format(config)
+
+
 if __name__ == "__main__":
     unittest.main()
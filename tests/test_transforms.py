@@ -0,0 +1,393 @@
+import math
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import munch
+import torch
+from monai.data import MetaTensor
+from monai.transforms import (
+    AsDiscreted,
+    CastToTyped,
+    Compose,
+    CropForegroundd,
+    EnsureTyped,
+    MapLabelValued,
+    NormalizeIntensityd,
+    RandRotated,
+    ScaleIntensityd,
+    Spacingd,
+    ToDeviced,
+)
+from monai.utils import optional_import
+from test_utils import TEST_CONFIG_SEGM
+
+from trainlib.transforms import (
+    _REGISTRY,
+    CachedCropForegroundd,
+    CachedSpacing,
+    CachedSpacingd,
+    FastMapLabelValued,
+    FusedScaleNormalized,
+    OneHotd,
+    StackChannelsd,
+    concat_columns,
+    get_base_transforms,
+    get_batch_transforms,
+    get_device_concat_keys,
+    get_train_transforms,
+    get_transform,
+    get_valid_transforms,
+)
+
+_, has_kornia = optional_import("kornia")
+
+
+def _index_of(compose, transform_type):
+    return [isinstance(tfm, transform_type) for tfm in compose.transforms].index(True)
+
+
+class TestDeferResampling(unittest.TestCase):
+    def setUp(self):
+        self.config = deepcopy(TEST_CONFIG_SEGM)
+        self.config.transforms.valid = {"CropForegroundd": {"source_key": "label"}}
+
+    def test_spacing_after_crop(self):
+        """Test that resampling is applied after foreground cropping"""
+        tfms = get_valid_transforms(self.config)
+        self.assertLess(_index_of(tfms, CropForegroundd), _index_of(tfms, Spacingd))
+        self.assertLess(_index_of(tfms, Spacingd), _index_of(tfms, EnsureTyped))
+
+    def test_disable_defer_resampling(self):
+        """Test that the order of base transforms is kept if `defer_resampling` is False"""
+        self.config.transforms.defer_resampling = False
+        tfms = get_valid_transforms(self.config)
+        self.assertLess(_index_of(tfms, Spacingd), _index_of(tfms, CropForegroundd))
+
+    def test_keep_spacing_before_spatial_transforms(self):
+        """Test that resampling is not deferred, if a spatial transform in base depends on the spacing"""
+        self.config.transforms.base.ResizeWithPadOrCropd = {"spatial_size": [64, 64, 64]}
+        tfms = get_valid_transforms(self.config)
+        self.assertLess(_index_of(tfms, Spacingd), _index_of(tfms, CropForegroundd))
+
+    def test_keep_spacing_before_crop_with_margin(self):
+        """Test that resampling is not deferred, if margin or k_divisible of the crop are given in voxels"""
+        self.config.transforms.valid["CropForegroundd"].update({"margin": 10, "k_divisible": 16})
+        tfms = get_valid_transforms(self.config)
+        self.assertLess(_index_of(tfms, Spacingd), _index_of(tfms, CropForegroundd))
+
+    def test_order_without_crop(self):
+        """Test that base transforms are applied first, if no foreground crop is specified"""
+        tfms = get_train_transforms(self.config)
+        self.assertEqual(_index_of(tfms, Spacingd), 2)
+
+
+class TestLazyResampling(unittest.TestCase):
+    def setUp(self):
+        self.config = deepcopy(TEST_CONFIG_SEGM)
+
+    def test_lazy(self):
+        """Test that pipelines are composed lazily with the interpolation mode of each key"""
+        tfms = get_train_transforms(self.config)
+        self.assertTrue(tfms.lazy)
+        self.assertEqual(tfms.overrides, {"image": {"mode": "bilinear"}, "label": {"mode": "nearest"}})
+
+    def test_disable_lazy(self):
+        self.config.transforms.lazy_resampling = False
+        tfms = get_valid_transforms(self.config)
+        self.assertFalse(tfms.lazy)
+
+
+class TestGpuIntensity(unittest.TestCase):
+    def setUp(self):
+        self.config = deepcopy(TEST_CONFIG_SEGM)
+        self.config.transforms.base.NormalizeIntensityd = {"keys": "image"}
+        self.config.transforms.gpu_intensity = True
+        self.config.data.dataset_type = "iterative"
+
+    def test_to_device_before_intensity(self):
+        """Test that images are moved to device before the first intensity transform"""
+        tfms = get_base_transforms(self.config)
+        to_device = _index_of(Compose(tfms), ToDeviced)
+        self.assertEqual(to_device + 1, _index_of(Compose(tfms), NormalizeIntensityd))
+        self.assertEqual(tfms[to_device].keys, ("image",))
+
+    def test_cached_dataset(self):
+        """Test that moving images to the GPU is rejected, if the output of the base transforms is cached"""
+        for dataset_type in ["persistent", "cache"]:
+            self.config.data.dataset_type = dataset_type
+            with self.assertRaises(ValueError):
+                get_base_transforms(self.config)
+
+
+class TestBatchedAffine(unittest.TestCase):
+    def setUp(self):
+        self.config = deepcopy(TEST_CONFIG_SEGM)
+        self.config.transforms.train = {"RandRotated": {"range_x": 0.3}, "RandZoomd": {"min_zoom": 0.8}}
+        self.config.transforms.batched_affine = True
+
+    def test_replace_random_affine_transforms(self):
+        """Test that random affine transforms are removed from the train transforms"""
+        tfms = get_train_transforms(self.config)
+        self.assertFalse(any(isinstance(tfm, RandRotated) for tfm in tfms.transforms))
+
+    @unittest.skipUnless(has_kornia, "Requires kornia")
+    def test_batch_transforms(self):
+        """Test that images and labels keep their shape and labels are not interpolated"""
+        batch_transform = get_batch_transforms(self.config)
+        image, label = torch.randn(2, 1, 8, 8, 8), torch.randint(0, 3, (2, 1, 8, 8, 8)).float()
+        image, label = batch_transform(image, label)
+        self.assertEqual(image.shape, (2, 1, 8, 8, 8))
+        self.assertTrue(set(label.unique().tolist()).issubset({0.0, 1.0, 2.0}))
+
+    @unittest.skipUnless(has_kornia, "Requires kornia")
+    def test_per_axis_ranges(self):
+        """Test that only configured axes are rotated and anisotropic scale ranges are kept per axis"""
+        self.config.transforms.train["RandAffined"] = {"scale_range": [0.0, 0.0, 0.2]}
+        batch_transform = get_batch_transforms(self.config)
+        params = batch_transform.image_affine.forward_parameters((64, 1, 8, 8, 8))
+        # kornia axes (x, y, z) are the spatial axes of monai in reverse order
+        angles, scale = params["angles"].abs().amax(0), params["scale"]
+        self.assertTrue(torch.all(angles[:2] == 0))
+        self.assertTrue(0 < angles[2] <= math.degrees(0.3))
+        self.assertTrue(torch.all(scale[:, 1:] <= 1.1) and torch.all(scale >= 0.8))
+        self.assertTrue(torch.all(scale[:, 0] <= 1.2))
+
+
+class TestStackChannelsd(unittest.TestCase):
+    def test_single_key(self):
+        """Test that a single item is not copied and kept at its key"""
+        image = torch.randn(1, 4, 4, 4)
+        out = StackChannelsd(keys="t1", name="image")({"t1": image})
+        self.assertIs(out["image"], image)
+        self.assertIs(out["t1"], image)
+
+    def test_single_column_with_target_name(self):
+        """Test that no stacking transform is used for a single column, which already has the target name"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.data.image_cols = ["image"]
+        config.data.label_cols = ["label"]
+        tfms = get_valid_transforms(config)
+        self.assertFalse(any(isinstance(tfm, StackChannelsd) for tfm in tfms.transforms))
+
+    def test_multiple_keys(self):
+        """Test that multiple items are concatenated along the channel dim"""
+        data = {"t1": torch.randn(1, 4, 4, 4), "t2": torch.randn(2, 4, 4, 4)}
+        out = StackChannelsd(keys=["t1", "t2"], name="image")(data)
+        self.assertEqual(out["image"].shape, (3, 4, 4, 4))
+        self.assertTrue(torch.equal(out["image"][1:], data["t2"]))
+
+
+class TestFastMapLabelValued(unittest.TestCase):
+    def test_same_as_map_label_valued(self):
+        """Test that labels are mapped like `MapLabelValued` and unmapped labels are kept"""
+        data = {"label": torch.tensor([[0, 1, 2, 3, 6, 7, 9]])}
+        args = {"keys": "label", "orig_labels": [1, 2, 3, 6], "target_labels": [1, 2, 2, 2]}
+        out = FastMapLabelValued(**args)(data)["label"]
+        expected = MapLabelValued(**args)(data)["label"]
+        self.assertTrue(torch.equal(out, expected))
+        self.assertEqual(out.dtype, expected.dtype)
+
+    def test_integer_input_to_float_labels(self):
+        """Test that target labels are not truncated to the dtype of an integer input"""
+        data = {"label": torch.tensor([[0, 1, 2, 3]], dtype=torch.uint8)}
+        args = {"keys": "label", "orig_labels": [1, 2], "target_labels": [0.5, 1.5]}
+        out = FastMapLabelValued(**args)(data)["label"]
+        expected = MapLabelValued(**args)(data)["label"]
+        self.assertTrue(torch.equal(out, expected))
+        self.assertEqual(out.dtype, torch.float32)
+
+    def test_substitute(self):
+        """Test that `MapLabelValued` in the config is replaced by `FastMapLabelValued`"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        tfm = get_transform("MapLabelValued", config=config, keys="label", orig_labels=[1], target_labels=[2])
+        self.assertIsInstance(tfm, FastMapLabelValued)
+
+
+class TestFusedScaleNormalized(unittest.TestCase):
+    def test_same_as_scale_and_normalize(self):
+        """Test that the fused transform gives the same result as `ScaleIntensityd` + `NormalizeIntensityd`"""
+        data = {"image": torch.rand(1, 8, 8, 8) * 1000 - 200}
+        expected = Compose([ScaleIntensityd(keys="image"), NormalizeIntensityd(keys="image")])(data)["image"]
+        out = FusedScaleNormalized(keys="image")(data)["image"]
+        self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+    def test_fuse_base_transforms(self):
+        """Test that `ScaleIntensityd` directly followed by `NormalizeIntensityd` is fused in base transforms"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.transforms.base.ScaleIntensityd = {"keys": "image"}
+        config.transforms.base.NormalizeIntensityd = {"keys": "image"}
+        tfms = get_base_transforms(config)
+        self.assertIsInstance(tfms[-1], FusedScaleNormalized)
+        self.assertFalse(any(isinstance(tfm, (ScaleIntensityd, NormalizeIntensityd)) for tfm in tfms))
+
+    def test_no_fusion_if_nonzero(self):
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.transforms.base.ScaleIntensityd = {"keys": "image"}
+        config.transforms.base.NormalizeIntensityd = {"keys": "image", "nonzero": True}
+        tfms = get_base_transforms(config)
+        self.assertIsInstance(tfms[-1], NormalizeIntensityd)
+
+
+class TestCachedSpacingd(unittest.TestCase):
+    def test_same_as_spacingd(self):
+        """Test that cached and uncached resampling give the same result and the geometry is cached once"""
+        affine = torch.diag(torch.tensor([0.7, 0.7, 1.5, 1.0], dtype=torch.float64))
+        data = {"image": MetaTensor(torch.rand(1, 10, 10, 6), affine=affine)}
+        cached_spacing = CachedSpacingd(keys="image", pixdim=[1, 1, 1])
+        expected = Spacingd(keys="image", pixdim=[1, 1, 1])(data)["image"]
+        for _ in range(2):
+            out = cached_spacing(data)["image"]
+            self.assertEqual(out.shape, expected.shape)
+            self.assertTrue(torch.allclose(out, expected))
+            self.assertTrue(torch.allclose(out.affine, expected.affine))
+        self.assertEqual(len(cached_spacing.spacing_transform.geometry_cache), 1)
+
+    def test_cache_size(self):
+        """Test that the least recently used geometry is dropped, if the cache is full"""
+        spacing = CachedSpacing(pixdim=[1, 1, 1], cache_size=1)
+        for shape in [(1, 10, 10, 6), (1, 8, 8, 6)]:
+            spacing(MetaTensor(torch.rand(*shape)))
+        self.assertEqual(list(spacing.geometry_cache)[0][0], (8, 8, 6))
+
+    def test_threads(self):
+        """Test that threads sharing a full cache do not fail on geometries evicted by other threads"""
+        spacing = CachedSpacing(pixdim=[1, 1, 1], cache_size=1)
+        images = [MetaTensor(torch.rand(1, 6 + i % 3, 6, 4)) for i in range(30)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            outputs = list(executor.map(spacing, images))
+        self.assertEqual(len(outputs), len(images))
+
+    def test_only_in_deterministic_stages(self):
+        """Test that the cached resampling is used in base, but not after random training transforms"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        self.assertTrue(any(isinstance(t, CachedSpacingd) for t in get_base_transforms(config)))
+        config.transforms.train = {"Spacingd": {"pixdim": [1, 1, 1]}}
+        train_spacing = [t for t in get_train_transforms(config).transforms if isinstance(t, Spacingd)][-1]
+        self.assertNotIsInstance(train_spacing, CachedSpacingd)
+
+
+class TestCachedCropForegroundd(unittest.TestCase):
+    def test_same_as_crop_foreground(self):
+        """Test that the cached bounding box gives the same crop and is computed once per case"""
+        label = torch.zeros(1, 10, 10, 6)
+        label[:, 2:5, 3:8, 1:4] = 1
+        data = {"image": torch.rand(1, 10, 10, 6), "label": MetaTensor(label, meta={"filename_or_obj": "label.nii"})}
+        args = {"keys": ["image", "label"], "source_key": "label"}
+        cached_crop = CachedCropForegroundd(**args)
+        expected = CropForegroundd(**args)(data)
+        for _ in range(2):
+            out = cached_crop(data)
+            for key in ["image", "label"]:
+                self.assertTrue(torch.equal(out[key], expected[key]))
+        self.assertEqual(len(cached_crop.bbox_cache), 1)
+
+    def test_only_in_deterministic_stages(self):
+        """Test that the cached crop is used for validation, but not for training"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.transforms.train = {"CropForegroundd": {"source_key": "label"}}
+        config.transforms.valid = {"CropForegroundd": {"source_key": "label"}}
+        self.assertFalse(any(isinstance(t, CachedCropForegroundd) for t in get_train_transforms(config).transforms))
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.transforms.valid = {"CropForegroundd": {"source_key": "label"}}
+        self.assertTrue(any(isinstance(t, CachedCropForegroundd) for t in get_valid_transforms(config).transforms))
+
+
+class TestOneHotd(unittest.TestCase):
+    def test_same_as_as_discreted(self):
+        """Test that predictions and labels are converted like with `AsDiscreted`"""
+        data = {"pred": torch.randn(3, 4, 4, 4), "label": torch.randint(0, 3, (1, 4, 4, 4)).float()}
+        args = {"keys": ["pred", "label"], "argmax": [True, False]}
+        out = OneHotd(num_classes=3, **args)(data)
+        expected = AsDiscreted(to_onehot=3, **args)(data)
+        for key in ["pred", "label"]:
+            self.assertTrue(torch.equal(out[key], expected[key]))
+
+    def test_classification(self):
+        """Test that class indices of classification labels are converted"""
+        data = {"pred": torch.tensor([0.1, 0.7]), "label": torch.tensor(1)}
+        out = OneHotd(keys=["pred", "label"], num_classes=2, argmax=[True, False])(data)
+        self.assertTrue(torch.equal(out["pred"], torch.tensor([0.0, 1.0])))
+        self.assertTrue(torch.equal(out["label"], torch.tensor([0.0, 1.0])))
+
+    @unittest.skipUnless(hasattr(torch, "compile"), "torch.compile not available")
+    def test_compile_kernel(self):
+        """Test that the compiled kernel gives the same result for inputs of different shapes"""
+        args = {"keys": ["pred", "label"], "num_classes": 3, "argmax": [True, False]}
+        compiled = OneHotd(compile_kernel=True, **args)
+        for shape in [(4, 4, 4), (5, 6, 7)]:
+            data = {"pred": torch.randn(3, *shape), "label": torch.randint(0, 3, (1, *shape)).float()}
+            out, expected = compiled(data), OneHotd(**args)(data)
+            for key in ["pred", "label"]:
+                self.assertTrue(torch.equal(out[key], expected[key]))
+
+
+class TestCompactLabels(unittest.TestCase):
+    def test_compact_labels(self):
+        """Test that labels are cast to uint8 before stacking"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.data.label_cols = ["seg"]
+        self.assertFalse(any(isinstance(tfm, CastToTyped) for tfm in get_valid_transforms(config).transforms))
+        config.transforms.compact_labels = True
+        tfms = get_valid_transforms(config)
+        self.assertLess(_index_of(tfms, CastToTyped), _index_of(tfms, StackChannelsd))
+        self.assertEqual(tfms.transforms[_index_of(tfms, CastToTyped)].keys, ("seg",))
+
+
+class TestConcatOnDevice(unittest.TestCase):
+    def test_no_stacking_in_transforms(self):
+        """Test that columns are not stacked by the transforms, if they are concatenated on the device"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.data.image_cols = ["t1", "t2"]
+        config.transforms.base.Spacingd.mode = ["bilinear", "bilinear", "nearest"]
+        config.transforms.mode = ["bilinear", "bilinear", "nearest"]
+        config.transforms.concat_on_device = True
+        tfms = get_valid_transforms(config)
+        self.assertFalse(any(isinstance(tfm, StackChannelsd) for tfm in tfms.transforms))
+        self.assertEqual(
+            get_device_concat_keys(config), {"image": config.data.image_cols, "label": config.data.label_cols}
+        )
+
+    def test_concat_columns(self):
+        """Test that concatenation of a batch gives the same result as stacking each item"""
+        items = [{"t1": torch.rand(1, 4, 4), "t2": torch.rand(1, 4, 4)} for _ in range(2)]
+        expected = torch.stack([StackChannelsd(keys=["t1", "t2"], name="image")(item)["image"] for item in items])
+        batch = {key: torch.stack([item[key] for item in items]) for key in ["t1", "t2"]}
+        out = concat_columns(batch, {"image": ["t1", "t2", "missing"]}, dim=1)
+        self.assertTrue(torch.equal(out["image"], expected))
+        self.assertIn("t1", out)
+
+
+class TestPatchedTransforms(unittest.TestCase):
+    def test_patch_not_substituted(self):
+        """Test that patched transforms are used in deterministic stages instead of cached substitutes"""
+        config = deepcopy(TEST_CONFIG_SEGM)
+        config.transforms.valid = {"CropForegroundd": {"source_key": "label"}}
+        with tempfile.TemporaryDirectory() as tempdir:
+            config.patch = munch.Munch(transforms=f"{tempdir}/patched_deterministic_transforms.py")
+            with open(config.patch.transforms, "w+") as f:
+                f.write("from monai.transforms import CropForegroundd, Spacingd\n")
+            tfms = get_valid_transforms(config)
+        self.assertIs(type(tfms.transforms[_index_of(tfms, Spacingd)]), Spacingd)
+        self.assertIs(type(tfms.transforms[_index_of(tfms, CropForegroundd)]), CropForegroundd)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_registry(self):
+        """Test that monai and trainlib dictionary transforms are registered with their category"""
+        self.assertEqual(_REGISTRY["Spacingd"].category, "spatial")
+        self.assertEqual(_REGISTRY["CachedSpacingd"].category, "spatial")
+        self.assertEqual(_REGISTRY["NormalizeIntensityd"].category, "intensity")
+        self.assertEqual(_REGISTRY["FusedScaleNormalized"].category, "intensity")
+        self.assertEqual(_REGISTRY["CropForegroundd"].category, "croppad")
+        self.assertNotIn("Spacing", _REGISTRY)
+
+    def test_array_transform(self):
+        config = deepcopy(TEST_CONFIG_SEGM)
+        with self.assertRaises(AssertionError):
+            get_transform("Spacing", config=config, pixdim=[1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,17 +5,20 @@ import shutil
 from collections import namedtuple
 from functools import partial
 from pathlib import Path
-from typing import Callable, Optional, Union
+from typing import Any, Callable, Dict, Optional, Union
 
 import munch
 import pandas as pd
 import torch
 from monai.data import DataLoader as MonaiDataLoader
+from monai.data import Dataset as MonaiDataset
+from monai.data import ThreadDataLoader as MonaiThreadDataLoader
 from monai.transforms import Compose
 from monai.utils import ensure_tuple
 from tqdm import tqdm
 
 from trainlib import transforms
+from trainlib.transforms import concat_columns
 from trainlib.utils import num_workers
 from trainlib.viewer import ListViewer
 
@@ -23,6 +26,7 @@ logger = logging.getLogger(__name__)
 
 
 def import_dataset(config: munch.Munch):
+    Dataset: Callable[..., MonaiDataset]  # noqa N806
     if config.data.dataset_type == "persistent":
         from monai.data import PersistentDataset
 
@@ -32,9 +36,12 @@ def import_dataset(config: munch.Munch):
         cache_dir.mkdir(parents=True, exist_ok=True)
         Dataset = partial(PersistentDataset, cache_dir=config.data.cache_dir)  # noqa N806  # noqa N806
     elif config.data.dataset_type == "cache":
-        from monai.data import CacheDataset  # noqa F401
+        from monai.data import CacheDataset
 
-        raise NotImplementedError("CacheDataset not yet implemented")
+        # deterministic transforms, up to the first random transform, are only applied once and kept in RAM
+        Dataset = partial(  # noqa N806
+            CacheDataset, cache_rate=config.data.get("cache_rate", 1.0), num_workers=num_workers()
+        )
     else:
         from monai.data import Dataset  # type: ignore
     return Dataset
@@ -70,9 +77,11 @@ class DataLoader(MonaiDataLoader):
     logger = logger
     start: int = 0  # first item for `show_batch`
 
-    def __init__(self, dataset, num_workers, task, **kwargs):
-        super().__init__(dataset, num_workers, **kwargs)
+    def __init__(self, dataset, num_workers, task, concat_keys: Optional[Dict] = None, **kwargs):
+        super().__init__(dataset, num_workers=num_workers, **kwargs)
         self.task = task
+        # columns, which are only concatenated on the device, see `transforms.get_device_concat_keys`
+        self.concat_keys = concat_keys or {}
 
     def show_batch(
         self,
@@ -102,7 +111,7 @@ class DataLoader(MonaiDataLoader):
         self.start = self.start + batch_size if (self.start + batch_size) < n_items else 0
         data = self.dataset.data[self.start : (self.start + batch_size)]  # type: ignore # noqa E203
 
-        batch = [transforms(item) for item in data]
+        batch = [concat_columns(transforms(item), self.concat_keys) for item in data]
         image = torch.stack([item[image_key] for item in batch], 0)
         label = torch.stack([item[label_key] for item in batch], 0)
 
@@ -170,6 +179,7 @@ class DataLoader(MonaiDataLoader):
                 if not isinstance(out, list):
                     out = [out]
                 for item in out:
+                    item = concat_columns(item, self.concat_keys)
                     image_fn = item["image"].meta["filename_or_obj"]
                     label_fn = item["label"].meta["filename_or_obj"]
                     image_shape = item["image"].shape
@@ -203,6 +213,7 @@ class DataLoader(MonaiDataLoader):
                 if not isinstance(out, list):
                     out = [out]
                 for item in out:
+                    item = concat_columns(item, self.concat_keys)
                     image_fn = item["image"].meta["filename_or_obj"]
                     image_shape = item["image"].shape
                     if max(image_shape) > 1000:
@@ -217,6 +228,13 @@ class DataLoader(MonaiDataLoader):
             self.logger.info(f"Value {value} appears in {unique_labels.count(value)} items in the dataset")
 
 
+class ThreadDataLoader(DataLoader, MonaiThreadDataLoader):
+    """`DataLoader` which prefetches batches in a background thread, so loading overlaps with training.
+    With `use_thread_workers`, transforms run in threads instead of worker processes, avoiding
+    the overhead of forking, as most heavy transforms release the GIL.
+    """
+
+
 def dataloaders(
     config: munch.Munch,
     train: Optional[bool] = None,
@@ -236,7 +254,13 @@ def dataloaders(
         label_cols: columns in csv containing path to label files
         dataset_type: PersistentDataset, CacheDataset and Dataset are supported
         cache_dir: cache directory to be used by PersistentDataset
+        cache_rate: fraction of the data cached in RAM by CacheDataset
         batch_size: batch size for training. Valid and test are always 1
+        persistent_workers: keep DataLoader workers alive between epochs
+        pin_memory: collate batches into page-locked memory, if training on the GPU
+        dataloader_type: `thread` to use a ThreadDataLoader, otherwise a DataLoader is used
+        use_thread_workers: run transforms in threads instead of processes, if dataloader_type is `thread`
+        buffer_size: number of batches prefetched by the ThreadDataLoader
         debug: run with reduced number of images
     Returns:
         list of:
@@ -295,10 +319,35 @@ def dataloaders(
     Dataset = import_dataset(config)  # noqa N806
     data_loaders = []
 
+    loader_kwargs: Dict[str, Any] = {}
+    use_thread_workers = False
+    if config.data.get("dataloader_type") == "thread":
+        use_thread_workers = config.data.get("use_thread_workers", True)
+        loader_kwargs = {"buffer_size": config.data.get("buffer_size", 4), "use_thread_workers": use_thread_workers}
+
+    # CUDA cannot be initialized in forked worker processes, so images are loaded in the main process
+    # if intensity transforms are applied on the GPU and the workers are not threads
+    gpu_intensity = transforms.use_gpu_intensity(config)
+    n_workers = 0 if gpu_intensity and not use_thread_workers else num_workers()
+    # keeping workers alive between epochs also keeps caches of transforms, such as `CachedSpacingd`
+    persistent_workers = bool(config.data.get("persistent_workers")) and n_workers > 0
+    # batches in page-locked memory can be copied asynchronously to the GPU, images already on the GPU cannot be pinned
+    pin_memory = (
+        config.data.get("pin_memory", True) and torch.device(config.device).type == "cuda" and not gpu_intensity
+    )
+
     for data_dict, transform in zip(data_dicts, data_transforms):
         data_set = Dataset(data=data_dict, transform=transform)
-        data_loader = DataLoader(
-            data_set, batch_size=batch_size, num_workers=num_workers(), shuffle=True, task=config.task
+        data_loader = (ThreadDataLoader if loader_kwargs else DataLoader)(
+            data_set,
+            batch_size=batch_size,
+            num_workers=n_workers,
+            shuffle=True,
+            persistent_workers=persistent_workers,
+            pin_memory=pin_memory,
+            task=config.task,
+            concat_keys=transforms.get_device_concat_keys(config),
+            **loader_kwargs,
         )
         data_loaders.append(data_loader)
 
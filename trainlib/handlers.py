@@ -150,6 +150,8 @@ class DebugHandler:
             keys.append("image")
         if "label" not in keys:
             keys.append("label")
+        # with `concat_on_device`, columns are only concatenated after the batch is moved to the device
+        keys = [key for key in keys if key in engine.state.batch]  # type: ignore
 
         message: str = self._table_row()
         for key in keys:
@@ -170,7 +172,10 @@ class DebugHandler:
                 "Therefore cannot check if model output fits to loss function"
             )
             return
-        labels = convert_to_tensor(engine.state.batch["label"])  # type: ignore
+        batch = engine.state.batch
+        # with `concat_on_device`, label columns are only concatenated after the batch is moved to the device
+        label_keys = ["label"] if "label" in batch else self.config.data.label_cols  # type: ignore
+        labels = torch.cat([convert_to_tensor(batch[key]).flatten() for key in label_keys])  # type: ignore
         unique = torch.unique(labels)
         if len(unique) > n_classes:
             self.logger.error(
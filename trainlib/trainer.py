@@ -1,5 +1,6 @@
 import shutil
 from copy import deepcopy
+from functools import partial
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
@@ -36,8 +37,8 @@ from trainlib.handlers import DebugHandler, EnsureTensor, PushnotificationHandle
 from trainlib.loss import get_loss
 from trainlib.model import get_model
 from trainlib.optimizer import get_optimizer
-from trainlib.transforms import get_post_transforms
-from trainlib.utils import USE_AMP
+from trainlib.transforms import concat_columns, get_batch_transforms, get_device_concat_keys, get_post_transforms
+from trainlib.utils import USE_AMP, get_memory_format
 
 
 def loss_logger(engine):
@@ -137,13 +138,25 @@ def _prepare_batch(
     batchdata: Union[Dict[str, torch.Tensor], torch.Tensor, Sequence[torch.Tensor]],
     device: Optional[Union[str, torch.device]] = None,
     non_blocking: bool = False,
+    batch_transform: Optional[Callable] = None,
+    memory_format: Optional[torch.memory_format] = None,
+    concat_keys: Optional[Dict[str, List[str]]] = None,
     **kwargs,
 ) -> Union[Tuple[torch.Tensor, Optional[torch.Tensor]], torch.Tensor]:
-    """Forces label to be torch.Tensor"""
+    """Concatenates the columns of `concat_keys` on the device, forces label to be torch.Tensor,
+    applies `batch_transform` to image and label on the device and converts the image to `memory_format`"""
     if isinstance(batchdata, dict):
+        if concat_keys:
+            batchdata = concat_columns(batchdata, concat_keys, dim=1, device=device, non_blocking=non_blocking)
         if not isinstance(batchdata.get(CommonKeys.LABEL), torch.Tensor):
             batchdata[CommonKeys.LABEL] = convert_to_tensor(batchdata[CommonKeys.LABEL], device=device)
-    return monai.engines.default_prepare_batch(batchdata, device, non_blocking)
+    batch = monai.engines.default_prepare_batch(batchdata, device, non_blocking)
+    if batch_transform is not None:
+        batch = batch_transform(*batch)
+    if memory_format is not None:
+        image, label = batch
+        batch = image.contiguous(memory_format=memory_format), label
+    return batch
 
 
 def get_train_handlers(evaluator: monai.engines.SupervisedEvaluator, config: munch.Munch) -> List:
@@ -237,6 +250,8 @@ def get_evaluator(
         inferer=inferer,
         key_val_metric=key_val_metric,
         val_handlers=val_handlers,  # type: ignore
+        non_blocking=True,  # asynchronous copy to device, if batches are in pinned memory
+        prepare_batch=partial(_prepare_batch, concat_keys=get_device_concat_keys(config)),
         # if no FP16 support in GPU or PyTorch version < 1.6, will not enable AMP evaluation
         amp=USE_AMP and config.device != torch.device("cpu"),
     )
@@ -260,6 +275,9 @@ class BaseTrainer(monai.engines.SupervisedTrainer):
         self.config.device = torch.device(self.config.device)
 
         network = get_model(config).to(config.device)
+        memory_format = get_memory_format(config)
+        if memory_format is not None:
+            network = network.to(memory_format=memory_format)
         optimizer = get_optimizer(network, config)
         loss_fn = get_loss(config)
         val_post_transforms = get_post_transforms(config=config)
@@ -286,7 +304,13 @@ class BaseTrainer(monai.engines.SupervisedTrainer):
             inferer=monai.inferers.SimpleInferer(),
             train_handlers=train_handlers,
             amp=USE_AMP and config.device != torch.device("cpu"),
-            prepare_batch=_prepare_batch,
+            non_blocking=True,  # asynchronous copy to device, if batches are in pinned memory
+            prepare_batch=partial(
+                _prepare_batch,
+                batch_transform=get_batch_transforms(config),
+                memory_format=memory_format,
+                concat_keys=get_device_concat_keys(config),
+            ),
         )
 
         if early_stopping:
@@ -561,10 +585,14 @@ class SegmentationTrainer(BaseTrainer):
             file = [file]
         images = {col_name: f for col_name, f in zip(self.config.data.image_cols, file)}
         dataloader = dataloaders(self.config, train=False, valid=False, test=True)
-        dataloader.dataset.data = [images]
+        if isinstance(dataloader.dataset, monai.data.CacheDataset):
+            dataloader.dataset.set_data([images])  # CacheDataset returns cached items instead of `data`
+        else:
+            dataloader.dataset.data = [images]
 
         with torch.no_grad():
             for batch in dataloader:
+                batch = concat_columns(batch, dataloader.concat_keys, dim=1, device=self.config.device)
                 data = batch["image"].to(self.config.device)
                 pred = inferer(inputs=data, network=self.network)
         if return_input:
@@ -1,58 +1,622 @@
+import functools
 import inspect
-from typing import Callable, List
+import math
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union, cast
 
 import monai
 import munch
-from monai.transforms import Compose
+import numpy as np
+import torch
+from monai.config import DtypeLike, IndexSelection, KeysCollection
+from monai.data import MetaTensor
+from monai.transforms import (
+    Compose,
+    ConcatItemsd,
+    CropForegroundd,
+    MapLabelValued,
+    MapTransform,
+    NormalizeIntensityd,
+    ScaleIntensityd,
+    Spacing,
+    Spacingd,
+)
+from monai.transforms.utils import is_positive
+from monai.utils import (
+    GridSampleMode,
+    GridSamplePadMode,
+    PytorchPadMode,
+    convert_data_type,
+    convert_to_dst_type,
+    convert_to_numpy,
+    convert_to_tensor,
+    ensure_tuple,
+    ensure_tuple_rep,
+    get_equivalent_dtype,
+)
 from monai.utils.enums import CommonKeys
 
 from trainlib.utils import get_n_classes_of_model_from_config, import_patched
 
+# random spatial transforms, which can be replaced by a single `BatchedAffine`
+BATCHED_AFFINE_TRANSFORMS = ("RandAffined", "RandRotated", "RandZoomd")
 
-def _concat_image_and_maybe_label(config: munch.Munch) -> List[Callable]:
-    """Final concatenation of images and label, so that they can be accessed via a standardized key"""
+# monai transforms, which are replaced by faster trainlib transforms with the same arguments
+TRANSFORM_SUBSTITUTES = {"MapLabelValued": "FastMapLabelValued"}
+# substitutes, which are only valid if all preceding transforms are deterministic
+DETERMINISTIC_TRANSFORM_SUBSTITUTES = {"CropForegroundd": "CachedCropForegroundd", "Spacingd": "CachedSpacingd"}
 
+# max. number of input geometries for which `CachedSpacing` keeps the target geometry
+GEOMETRY_CACHE_SIZE = 1024
+
+# max. label value for which a lookup table is used in `FastMapLabelValued`
+MAX_LUT_SIZE = 2**16
+
+# categories of transforms, derived from the monai module the transform (or its base class) is defined in
+TRANSFORM_CATEGORIES = ("spatial", "intensity", "croppad")
+# categories of trainlib transforms, which cannot be derived from their base class
+TRAINLIB_TRANSFORM_CATEGORIES = {"FusedScaleNormalized": "intensity"}
+
+
+class BatchedAffine(torch.nn.Module):
+    """Random affine augmentation of a whole batch at once on the device of the batch, using `kornia`.
+    The same transformation is applied to image and label of an item, labels are resampled
+    with nearest neighbour interpolation.
+
+    Args:
+        ndim: number of spatial dimensions (2 or 3)
+        degrees: range of rotation in degrees, `(min, max)` in 2D and one `(min, max)` per axis (x, y, z) in 3D
+        scale: range of scaling factors, `(min_x, max_x, min_y, max_y)` in 2D and one `(min, max)` per axis in 3D
+        translate: maximum translation per axis as fraction of the image size
+        prob: probability of an item to be transformed
+        transform_label: whether the label is an image and should be transformed as well
+    """
+
+    def __init__(
+        self,
+        ndim: int,
+        degrees: Union[Tuple[float, float], Tuple[Tuple[float, float], ...]],
+        scale: Optional[Union[Tuple[float, ...], Tuple[Tuple[float, float], ...]]] = None,
+        translate: Optional[Tuple[float, ...]] = None,
+        prob: float = 0.1,
+        transform_label: bool = True,
+    ) -> None:
+        super().__init__()
+        try:
+            from kornia import augmentation
+        except ImportError:
+            raise ImportError("`BatchedAffine` requires kornia, which can be installed with `pip install kornia`")
+        random_affine = augmentation.RandomAffine3D if ndim == 3 else augmentation.RandomAffine
+        kwargs: Dict[str, Any] = {"degrees": degrees, "scale": scale, "translate": translate, "p": prob}
+        self.image_affine = random_affine(resample="bilinear", **kwargs)
+        self.label_affine = random_affine(resample="nearest", **kwargs)
+        self.transform_label = transform_label
+
+    def forward(
+        self, image: torch.Tensor, label: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        image = convert_to_tensor(image, track_meta=False)
+        params = self.image_affine.forward_parameters(image.shape)
+        image = self.image_affine(image, params=params)
+        if self.transform_label and label is not None:
+            label = convert_to_tensor(label, track_meta=False)
+            label = self.label_affine(label.float(), params=params).to(label.dtype)
+        return image, label
+
+
+class StackChannelsd(ConcatItemsd):
+    """Concatenate `keys` along the channel dim and store the result at `name`.
+    If only a single key is given, the item is stored at `name` as is, without copying the data.
+    The item is also kept at its key, as handlers read the meta data of the image columns.
+    """
+
+    def __call__(self, data):
+        d = dict(data)
+        keys = list(self.key_iterator(d))
+        if len(keys) == 1:
+            d[self.name] = d[keys[0]]
+            return d
+        return super().__call__(d)
+
+
+class FastMapLabelValued(MapLabelValued):
+    """`MapLabelValued` using a lookup table, so each voxel is only read once instead of once per label.
+    Falls back to `MapLabelValued` if `orig_labels` are not non-negative integers smaller than `MAX_LUT_SIZE`.
+    Voxels with values not in `orig_labels` are kept unchanged.
+    """
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        orig_labels: List,
+        target_labels: List,
+        dtype: DtypeLike = np.float32,
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, orig_labels, target_labels, dtype=dtype, allow_missing_keys=allow_missing_keys)
+        self.lut: Optional[torch.Tensor] = None
+        if all(float(o).is_integer() and 0 <= o < MAX_LUT_SIZE for o in orig_labels):
+            self.lut = torch.arange(int(max(orig_labels, default=0)) + 1, dtype=torch.float64)
+            for o, t in zip(orig_labels, target_labels):
+                self.lut[int(o)] = t
+
+    def _map(self, img):
+        img_t, *_ = convert_data_type(img, torch.Tensor)
+        lut = self.lut.to(img_t.device)  # type: ignore
+        idx = img_t.long()
+        # map in the output dtype, so target labels are not truncated to the dtype of integer inputs
+        dtype = get_equivalent_dtype(self.mapper.dtype, torch.Tensor)
+        mapped = lut[idx.clamp(0, len(lut) - 1)].to(dtype)
+        out = torch.where((idx == img_t) & (idx >= 0) & (idx < len(lut)), mapped, img_t.to(dtype))
+        return convert_to_dst_type(out, dst=img, dtype=dtype)[0]
+
+    def __call__(self, data):
+        if self.lut is None:
+            return super().__call__(data)
+        d = dict(data)
+        for key in self.key_iterator(d):
+            d[key] = self._map(d[key])
+        return d
+
+
+class FusedScaleNormalized(MapTransform):
+    """Fused `ScaleIntensityd` and `NormalizeIntensityd`.
+    Normalizing to zero mean and unit variance is invariant to the linear rescaling of `ScaleIntensityd`,
+    so the result is identical, but mean and std are computed in a single pass over the image.
+    `minv` and `maxv` are only kept for compatibility with the arguments of `ScaleIntensityd`.
+    """
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        minv: Optional[float] = 0.0,
+        maxv: Optional[float] = 1.0,
+        dtype: DtypeLike = np.float32,
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.dtype = dtype
+
+    def _normalize(self, img):
+        img_t, *_ = convert_data_type(img, torch.Tensor, dtype=torch.float32)
+        std, mean = torch.std_mean(img_t, unbiased=False)
+        out = torch.sub(img_t, mean).div_(std if std > 0 else 1.0)
+        return convert_to_dst_type(out, dst=img, dtype=self.dtype)[0]
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            d[key] = self._normalize(d[key])
+        return d
+
+
+class CachedSpacing(Spacing):
+    """`Spacing`, which caches the output affine and shape for each input geometry (shape and affine).
+    Images with an already seen geometry are resampled directly, without recomputing the target affine.
+    The cache lives as long as the transform, so it persists over epochs if the transform
+    runs in the main process, threads or persistent workers. The least recently used geometry
+    is dropped, if more than `cache_size` geometries are cached. The cache can be shared by threads,
+    as each entry is only looked up once per call.
+    """
+
+    def __init__(self, *args, cache_size: int = GEOMETRY_CACHE_SIZE, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache_size = cache_size
+        self.geometry_cache: OrderedDict[Tuple, Tuple[torch.Tensor, List[int]]] = OrderedDict()
+
+    def __call__(  # type: ignore
+        self,
+        data_array: torch.Tensor,
+        mode: Optional[str] = None,
+        padding_mode: Optional[str] = None,
+        align_corners: Optional[bool] = None,
+        dtype: DtypeLike = None,
+        scale_extent: Optional[bool] = None,
+        output_spatial_shape: Optional[Union[Sequence[int], int]] = None,
+        lazy: Optional[bool] = None,
+    ) -> torch.Tensor:
+        if not isinstance(data_array, MetaTensor) or self.recompute_affine:
+            return super().__call__(
+                data_array,
+                mode=mode,
+                padding_mode=padding_mode,
+                align_corners=align_corners,
+                dtype=dtype,
+                scale_extent=scale_extent,
+                output_spatial_shape=output_spatial_shape,
+                lazy=lazy,
+            )
+        key = (
+            tuple(data_array.peek_pending_shape()),
+            tuple(convert_to_numpy(data_array.peek_pending_affine()).ravel().tolist()),
+            scale_extent,
+            None if output_spatial_shape is None else tuple(ensure_tuple(output_spatial_shape)),
+        )
+        # a single lookup, as other threads (e.g. thread workers) can evict the key at any time
+        cached = self.geometry_cache.get(key)
+        if cached is None:
+            out = cast(
+                MetaTensor,
+                super().__call__(
+                    data_array,
+                    mode=mode,
+                    padding_mode=padding_mode,
+                    align_corners=align_corners,
+                    dtype=dtype,
+                    scale_extent=scale_extent,
+                    output_spatial_shape=output_spatial_shape,
+                    lazy=lazy,
+                ),
+            )
+            self.geometry_cache[key] = (out.peek_pending_affine().clone(), list(out.peek_pending_shape()))
+            if len(self.geometry_cache) > self.cache_size:
+                try:
+                    self.geometry_cache.popitem(last=False)
+                except KeyError:  # emptied by another thread
+                    pass
+            return out
+        try:
+            self.geometry_cache.move_to_end(key)
+        except KeyError:  # evicted by another thread
+            pass
+        dst_affine, spatial_size = cached
+        return self.sp_resample(
+            data_array,
+            dst_affine=dst_affine.clone(),
+            spatial_size=spatial_size,
+            mode=mode,
+            padding_mode=padding_mode,
+            align_corners=align_corners,
+            dtype=dtype,
+            lazy=self.lazy if lazy is None else lazy,
+        )
+
+
+class CachedSpacingd(Spacingd):
+    """`Spacingd` using `CachedSpacing`, see there"""
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        pixdim: Union[Sequence[float], float],
+        diagonal: bool = False,
+        mode: Union[str, Sequence[str]] = GridSampleMode.BILINEAR,
+        padding_mode: Union[str, Sequence[str]] = GridSamplePadMode.BORDER,
+        align_corners: Union[bool, Sequence[bool]] = False,
+        dtype: Union[DtypeLike, Sequence[DtypeLike]] = np.float64,
+        scale_extent: bool = False,
+        recompute_affine: bool = False,
+        min_pixdim: Union[Sequence[float], float, None] = None,
+        max_pixdim: Union[Sequence[float], float, None] = None,
+        ensure_same_shape: bool = True,
+        allow_missing_keys: bool = False,
+        lazy: bool = False,
+    ) -> None:
+        super().__init__(
+            keys,
+            pixdim,
+            diagonal=diagonal,
+            mode=mode,
+            padding_mode=padding_mode,
+            align_corners=align_corners,
+            dtype=dtype,
+            scale_extent=scale_extent,
+            recompute_affine=recompute_affine,
+            min_pixdim=min_pixdim,
+            max_pixdim=max_pixdim,
+            ensure_same_shape=ensure_same_shape,
+            allow_missing_keys=allow_missing_keys,
+            lazy=lazy,
+        )
+        self.spacing_transform = CachedSpacing(
+            pixdim,
+            diagonal=diagonal,
+            recompute_affine=recompute_affine,
+            min_pixdim=min_pixdim,
+            max_pixdim=max_pixdim,
+            lazy=lazy,
+        )
+
+
+class CachedCropForegroundd(CropForegroundd):
+    """`CropForegroundd`, which computes the bounding box of each case only once.
+    Cases are identified by filename, shape and affine of `source_key`, so all transforms
+    before this transform need to be deterministic (e.g. in validation and test transforms).
+    """
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        source_key: str,
+        select_fn: Callable = is_positive,
+        channel_indices: Optional[IndexSelection] = None,
+        margin: Union[Sequence[int], int] = 0,
+        allow_smaller: bool = True,
+        k_divisible: Union[Sequence[int], int] = 1,
+        mode: Union[str, Sequence[str]] = PytorchPadMode.CONSTANT,
+        start_coord_key: Optional[str] = "foreground_start_coord",
+        end_coord_key: Optional[str] = "foreground_end_coord",
+        allow_missing_keys: bool = False,
+        lazy: bool = False,
+        **pad_kwargs,
+    ) -> None:
+        super().__init__(
+            keys,
+            source_key,
+            select_fn=select_fn,
+            channel_indices=channel_indices,
+            margin=margin,
+            allow_smaller=allow_smaller,
+            k_divisible=k_divisible,
+            mode=mode,
+            start_coord_key=start_coord_key,
+            end_coord_key=end_coord_key,
+            allow_missing_keys=allow_missing_keys,
+            lazy=lazy,
+            **pad_kwargs,
+        )
+        self.bbox_cache: Dict[Tuple, Tuple] = {}
+
+    def __call__(self, data, lazy: Optional[bool] = None):
+        source = data[self.source_key]
+        if not isinstance(source, MetaTensor) or "filename_or_obj" not in source.meta:
+            return super().__call__(data, lazy=lazy)
+        key = (
+            str(source.meta["filename_or_obj"]),
+            tuple(source.shape),
+            tuple(convert_to_numpy(source.affine).ravel().tolist()),
+        )
+        if key not in self.bbox_cache:
+            self.bbox_cache[key] = self.cropper.compute_bounding_box(img=source)
+        box_start, box_end = self.bbox_cache[key]
+
+        d = dict(data)
+        if self.start_coord_key is not None:
+            d[self.start_coord_key] = box_start
+        if self.end_coord_key is not None:
+            d[self.end_coord_key] = box_end
+        lazy_ = self.lazy if lazy is None else lazy
+        for key, m in self.key_iterator(d, self.mode):
+            d[key] = self.cropper.crop_pad(img=d[key], box_start=box_start, box_end=box_end, mode=m, lazy=lazy_)
+        return d
+
+
+def _scatter_one_hot(img: torch.Tensor, num_classes: int, argmax: bool, dtype: torch.dtype) -> torch.Tensor:
+    """Scatter the class indices of `img` (or of its argmax along the channel dim) into a one-hot tensor"""
+    index = img.argmax(0, keepdim=True) if argmax else img.long()
+    out = torch.zeros((num_classes, *index.shape[1:]), dtype=dtype, device=index.device)
+    return out.scatter_(0, index, 1)
+
+
+class OneHotd(MapTransform):
+    """Convert predictions (with `argmax`) and labels to one-hot format.
+    Same as `AsDiscreted(argmax=argmax, to_onehot=num_classes)`, but the class indices are
+    scattered directly into the one-hot tensor, instead of materializing the discrete tensor first.
+
+    Args:
+        compile_kernel: fuse argmax and scatter with `torch.compile`. Shapes are treated as dynamic,
+            as validation images differ in size. Ignored if `torch.compile` is not available.
+    """
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        num_classes: int,
+        argmax: Union[Sequence[bool], bool] = False,
+        dtype: torch.dtype = torch.float32,
+        compile_kernel: bool = False,
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.num_classes = num_classes
+        self.argmax = ensure_tuple_rep(argmax, len(self.keys))
+        self.dtype = dtype
+        self.kernel: Callable = _scatter_one_hot
+        if compile_kernel and hasattr(torch, "compile"):
+            self.kernel = torch.compile(_scatter_one_hot, dynamic=True)
+
+    def _one_hot(self, img, argmax: bool):
+        img_t = convert_to_tensor(img, track_meta=False)
+        if img_t.ndim == 0:  # class index of classification label
+            img_t = img_t.reshape(1)
+        out = self.kernel(img_t, self.num_classes, argmax, self.dtype)
+        return convert_to_dst_type(out, dst=img, dtype=self.dtype)[0]
+
+    def __call__(self, data):
+        d = dict(data)
+        for key, argmax in self.key_iterator(d, self.argmax):
+            d[key] = self._one_hot(d[key], argmax)
+        return d
+
+
+RegistryEntry = namedtuple("RegistryEntry", ["transform", "category"])
+
+
+def _category(transform: type) -> str:
+    """Category of a transform class: `spatial`, `intensity`, `croppad` or `other`"""
+    if transform.__name__ in TRAINLIB_TRANSFORM_CATEGORIES:
+        return TRAINLIB_TRANSFORM_CATEGORIES[transform.__name__]
+    for cls in transform.__mro__:
+        for category in TRANSFORM_CATEGORIES:
+            if f".{category}." in cls.__module__:
+                return category
+    return "other"
+
+
+def _build_registry() -> Dict[str, RegistryEntry]:
+    """Collect all dictionary transforms from monai and trainlib once, with their category"""
+    transforms = {name: getattr(monai.transforms, name) for name in dir(monai.transforms)}
+    transforms = {name: t for name, t in transforms.items() if isinstance(t, type) and "dictionary" in t.__module__}
+    for name, t in globals().items():
+        if isinstance(t, type) and issubclass(t, MapTransform) and t.__module__ == __name__:
+            transforms[name] = t
+    return {name: RegistryEntry(t, _category(t)) for name, t in transforms.items()}
+
+
+def _transform_category(tfm: Callable) -> str:
+    entry = _REGISTRY.get(type(tfm).__name__)
+    if entry is not None and entry.transform is type(tfm):
+        return entry.category
+    return _category(type(tfm))  # patched transforms are not in the registry
+
+
+def _can_fuse_scale_and_normalize(scale: ScaleIntensityd, normalize: NormalizeIntensityd) -> bool:
+    """Whether z-score normalization is invariant to the preceding rescaling"""
+    scaler, normalizer = scale.scaler, normalize.normalizer
+    return (
+        scale.keys == normalize.keys
+        and scale.allow_missing_keys == normalize.allow_missing_keys
+        and scaler.factor is None
+        and not scaler.channel_wise
+        and scaler.minv is not None
+        and scaler.maxv is not None
+        and scaler.minv < scaler.maxv
+        and normalizer.subtrahend is None
+        and normalizer.divisor is None
+        and not normalizer.nonzero
+        and not normalizer.channel_wise
+    )
+
+
+def _fuse_scale_and_normalize(tfms: List[Callable]) -> List[Callable]:
+    """Replace `ScaleIntensityd` directly followed by `NormalizeIntensityd` with `FusedScaleNormalized`"""
+    fused: List[Callable] = []
+    for tfm in tfms:
+        previous = fused[-1] if fused else None
+        if (
+            isinstance(previous, ScaleIntensityd)
+            and isinstance(tfm, NormalizeIntensityd)
+            and _can_fuse_scale_and_normalize(previous, tfm)
+        ):
+            fused[-1] = FusedScaleNormalized(
+                keys=tfm.keys, dtype=tfm.normalizer.dtype, allow_missing_keys=tfm.allow_missing_keys
+            )
+        else:
+            fused.append(tfm)
+    return fused
+
+
+_REGISTRY = _build_registry()
+
+
+def get_device_concat_keys(config: munch.Munch) -> Dict[str, List[str]]:
+    """Columns, which are concatenated on the device by `concat_columns` instead of in the transforms,
+    if `concat_on_device` is set. Maps the standardized key to the columns concatenated into it.
+    """
+    if not config.transforms.get("concat_on_device"):
+        return {}
+    concat_keys: Dict[str, List[str]] = {CommonKeys.IMAGE: list(config.data.image_cols)}
+    if config.task == "segmentation":
+        concat_keys[CommonKeys.LABEL] = list(config.data.label_cols)
+    return concat_keys
+
+
+def concat_columns(
+    data: Dict,
+    concat_keys: Dict[str, List[str]],
+    dim: int = 0,
+    device: Optional[Union[str, torch.device]] = None,
+    non_blocking: bool = False,
+) -> Dict:
+    """Concatenate the columns of `concat_keys` along `dim`, after moving each column to `device`.
+    `data` is modified in place, so the concatenated keys are also available to handlers using the batch.
+    The columns are kept, as handlers such as the `MetricsSaver` read their meta data.
+
+    Args:
+        data: an item (concatenate along `dim=0`) or a batch (along `dim=1`)
+        concat_keys: maps the new key to the columns concatenated into it, see `get_device_concat_keys`
+        dim: dimension along which the columns are concatenated
+        device: device to move the columns to before concatenation, keeps the device if None
+        non_blocking: copy asynchronously to `device`, if the columns are in pinned memory
+    """
+    for name, cols in concat_keys.items():
+        tensors = [data[col] for col in cols if col in data]  # labels can be missing in test data
+        if not tensors:
+            continue
+        if device is not None:
+            tensors = [t.to(device, non_blocking=non_blocking) for t in tensors]
+        data[name] = tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=dim)
+    return data
+
+
+def _stack_channels(config: munch.Munch, cols: Sequence[str], name: str, **kwargs) -> List[Callable]:
+    """Stack `cols` into `name`, no transform is needed if there is a single column named `name`"""
+    if list(ensure_tuple(cols)) == [name]:
+        return []
+    return [get_transform("StackChannelsd", config=config, keys=cols, name=name, dim=0, **kwargs)]
+
+
+def _concat_image_and_maybe_label(config: munch.Munch, allow_missing_labels: bool = False) -> List[Callable]:
+    """Final concatenation of images and label, so that they can be accessed via a standardized key.
+    With `allow_missing_labels`, items without labels (e.g. for prediction) are passed through.
+    """
+
+    device_concat_keys = get_device_concat_keys(config)
+    # only passed if set, as explicit arguments overwrite the config of the transform
+    label_kwargs = {"allow_missing_keys": True} if allow_missing_labels else {}
     concat_transforms = [
         get_transform(
-            "ConcatItemsd",
-            config=config,
-            keys=config.data.image_cols,
-            name=CommonKeys.IMAGE,
-            dim=0,
-        ),
-        get_transform("SelectItemsd", config=config, keys=config.data.label_cols + config.data.image_cols),
+            "SelectItemsd", config=config, keys=config.data.label_cols + config.data.image_cols, **label_kwargs
+        )
     ]
+    if CommonKeys.IMAGE not in device_concat_keys:
+        concat_transforms += _stack_channels(config, config.data.image_cols, CommonKeys.IMAGE)
 
-    if config.task == "segmentation":
+    if config.task == "segmentation" and config.transforms.get("compact_labels"):
+        # class indices as uint8 need a quarter of the memory of float32 and are expanded to one-hot by the
+        # loss function (`to_onehot_y`) and `OneHotd` in the post transforms only when needed
         concat_transforms += [
             get_transform(
-                "ConcatItemsd",
+                "CastToTyped",
                 config=config,
                 keys=config.data.label_cols,
-                name=CommonKeys.LABEL,
-                dim=0,
+                dtype=torch.uint8,
+                allow_missing_keys=True,
             )
         ]
+
+    if config.task == "segmentation" and CommonKeys.LABEL not in device_concat_keys:
+        concat_transforms += _stack_channels(config, config.data.label_cols, CommonKeys.LABEL, **label_kwargs)
     # TODO: This only works for one label. It would be better if a way is found to also concat these labels
     # CommonKeys.LABEL should still be used, as the monai.engines also use this internally.
     if config.task == "classification" and config.data.label_cols[0] != CommonKeys.LABEL:
         concat_transforms += [
-            get_transform("CopyItemsd", config=config, keys=config.data.label_cols, times=1, names=[CommonKeys.LABEL])
+            get_transform(
+                "CopyItemsd",
+                config=config,
+                keys=config.data.label_cols,
+                times=1,
+                names=[CommonKeys.LABEL],
+                **label_kwargs,
+            )
         ]
 
     return concat_transforms
 
 
-def get_transform(tfm_name: str, config: munch.Munch, **kwargs):
-    """Get transform from monai.transforms with arguments from config"""
+@functools.lru_cache(maxsize=256)
+def _allowed_kwargs(transform: Callable) -> frozenset:
+    """Names of the arguments accepted by `transform`, cached as signatures are inspected for every transform"""
+    return frozenset(inspect.signature(transform.__init__).parameters)  # type: ignore
+
+
+def get_transform(tfm_name: str, config: munch.Munch, deterministic: bool = False, **kwargs):
+    """Get transform from monai.transforms with arguments from config.
+    If all preceding transforms are `deterministic`, transforms from `DETERMINISTIC_TRANSFORM_SUBSTITUTES`
+    are used as well. Patched transforms are never substituted.
+    """
     try:
         transform = import_patched(config.patch.transforms, tfm_name)
     except AttributeError:
-        if hasattr(monai.transforms, tfm_name):
-            transform = getattr(monai.transforms, tfm_name)
-            assert "dictionary" in transform.__module__, f"{tfm_name} is not a dictionary transform"
+        tfm_class_name = TRANSFORM_SUBSTITUTES.get(tfm_name, tfm_name)
+        if deterministic:
+            tfm_class_name = DETERMINISTIC_TRANSFORM_SUBSTITUTES.get(tfm_name, tfm_class_name)
+        if tfm_class_name in _REGISTRY:
+            transform = _REGISTRY[tfm_class_name].transform
+        elif hasattr(monai.transforms, tfm_name):
+            raise AssertionError(f"{tfm_name} is not a dictionary transform")
         else:
-            raise AttributeError(f"{tfm_name} not in `monai.transforms` nor in {config.patch.transforms}")
+            raise AttributeError(f"{tfm_name} not in `trainlib.transforms`, `monai.transforms` nor patched")
     # merge config for transform type (train, valid, test) with kwargs
     for k in config.transforms.keys():
         if isinstance(config.transforms[k], dict) and tfm_name in config.transforms[k].keys():
@@ -63,27 +627,124 @@ def get_transform(tfm_name: str, config: munch.Munch, **kwargs):
             if transform_config[tfm_name] is not None:
                 kwargs = {**transform_config[tfm_name], **kwargs}
 
-    allowed_kwargs = inspect.signature(transform.__init__).parameters.keys()  # type: ignore
+    allowed_kwargs = _allowed_kwargs(transform)
     if "keys" not in kwargs.keys():
         kwargs["keys"] = config.data.image_cols + config.data.label_cols
     if "prob" in allowed_kwargs and "prob" not in kwargs.keys():
         kwargs["prob"] = config.transforms.prob
     # Finally remove all kwargs, which are not accepted by the function
-    for k in list(kwargs.keys()):
-        if k not in allowed_kwargs:
-            kwargs.pop(k)
-    return transform(**kwargs)
+    return transform(**{k: v for k, v in kwargs.items() if k in allowed_kwargs})
 
 
 def get_base_transforms(config: munch.Munch) -> List[Callable]:
     """Transforms applied everytime at the start of the transform pipeline"""
-    tfms = []
-    if "base" in config.transforms.keys():
-        tfm_names = list(config.transforms.base)
-        tfms += [get_transform(tn, config) for tn in tfm_names]
+    tfms = _get_stage_transforms(config, "base", deterministic=True)
+    tfms = _fuse_scale_and_normalize(tfms)
+    if use_gpu_intensity(config):
+        tfms = _move_to_device_before_intensity_transforms(config, tfms)
+    return tfms
+
+
+def use_gpu_intensity(config: munch.Munch) -> bool:
+    """Whether base intensity transforms run on the GPU, see `config.transforms.gpu_intensity`.
+    Persistent and cache datasets store the output of the deterministic transforms, so the intensity
+    transforms would only run once and the images would be cached on the GPU, which is not supported.
+    """
+    if not config.transforms.get("gpu_intensity"):
+        return False
+    if config.data.get("dataset_type") in ("persistent", "cache"):
+        raise ValueError(
+            "`gpu_intensity` is not supported with `dataset_type` persistent or cache, "
+            "as the output of the base transforms is cached"
+        )
+    return True
+
+
+def _move_to_device_before_intensity_transforms(config: munch.Munch, tfms: List[Callable]) -> List[Callable]:
+    """Move images to `config.device` before the first intensity transform, so that
+    intensity scaling and normalization run on the GPU without host-device round-trips.
+    """
+    for i, tfm in enumerate(tfms):
+        if _transform_category(tfm) == "intensity":
+            to_device = [
+                get_transform(
+                    "EnsureTyped", config=config, keys=config.data.image_cols, data_type="tensor", track_meta=True
+                ),
+                get_transform("ToDeviced", config=config, keys=config.data.image_cols, device=config.device),
+            ]
+            return tfms[:i] + to_device + tfms[i:]
     return tfms
 
 
+def _split_resampling_transforms(tfms: List[Callable]) -> Tuple[List[Callable], List[Callable]]:
+    """Split transforms into `pre_spatial` transforms and resampling transforms (`post_spatial`),
+    which can be applied after cropping, so they only need to process the cropped volume.
+    Resampling is not deferred, if a spatial or crop/pad transform follows it, as these can
+    depend on the target spacing (e.g. `spatial_size` of `ResizeWithPadOrCropd`).
+    """
+    pre_spatial: List[Callable] = []
+    post_spatial: List[Callable] = []
+    for tfm in tfms:
+        if isinstance(tfm, Spacingd):
+            post_spatial.append(tfm)
+        elif post_spatial and _transform_category(tfm) in ("spatial", "croppad"):
+            return tfms, []
+        else:
+            pre_spatial.append(tfm)
+    return pre_spatial, post_spatial
+
+
+def _crop_is_independent_of_spacing(tfm: Callable) -> bool:
+    """Whether `tfm` is a foreground crop, which gives the same region before and after resampling.
+    `margin` and `k_divisible` are given in voxels, so they depend on the spacing of the image.
+    """
+    if not isinstance(tfm, CropForegroundd):
+        return False
+    cropper = tfm.cropper
+    return all(m == 0 for m in ensure_tuple(cropper.margin)) and all(k == 1 for k in ensure_tuple(cropper.k_divisible))
+
+
+def _prepend_base_transforms(
+    config: munch.Munch, tfms: List[Callable], after_base: Optional[List[Callable]] = None
+) -> List[Callable]:
+    """Prepend base transforms (and `after_base`) to the transforms of a stage (train, valid, test).
+    If the stage starts with foreground cropping, resampling is deferred until after the crop.
+    Because MetaTensors keep track of the affine, the cropped region is resampled to the same
+    physical space. Crops with a `margin` or `k_divisible` are not deferred, as these are given in voxels.
+    """
+    base_tfms = get_base_transforms(config=config)
+    after_base = after_base or []
+    n_crops = 0
+    if config.transforms.get("defer_resampling", True):
+        while n_crops < len(tfms) and _crop_is_independent_of_spacing(tfms[n_crops]):
+            n_crops += 1
+    if n_crops == 0:
+        return base_tfms + after_base + tfms
+    pre_spatial, post_spatial = _split_resampling_transforms(base_tfms)
+    return pre_spatial + tfms[:n_crops] + post_spatial + after_base + tfms[n_crops:]
+
+
+def _get_stage_transforms(
+    config: munch.Munch, stage: str, exclude: Sequence[str] = (), deterministic: bool = False
+) -> List[Callable]:
+    """Build the transforms of a stage (base, train, valid, test) in the order given in the config.
+    If the stage is `deterministic`, transforms with a cache that is only valid for
+    deterministic pipelines are used, see `DETERMINISTIC_TRANSFORM_SUBSTITUTES`.
+    """
+    tfm_names = config.transforms.get(stage) or []
+    return [get_transform(tn, config, deterministic=deterministic) for tn in tfm_names if tn not in exclude]
+
+
+def _compose(config: munch.Munch, tfms: List[Callable]) -> Compose:
+    """Compose transforms with lazy resampling, so consecutive spatial transforms are fused into a
+    single resampling step. Pending operations are applied before the next non-lazy transform
+    (e.g. intensity transforms), using the interpolation mode of each key from `config.transforms.mode`.
+    """
+    keys = config.data.image_cols + config.data.label_cols
+    overrides = {key: {"mode": mode} for key, mode in zip(keys, config.transforms.mode)}
+    return Compose(tfms, lazy=config.transforms.get("lazy_resampling", True), overrides=overrides)
+
+
 def get_train_transforms(config: munch.Munch) -> Compose:
     """Build transforms dynamically from config for data augmentation during training.
     Args:
@@ -91,12 +752,11 @@ def get_train_transforms(config: munch.Munch) -> Compose:
     Returns:
         Composed transforms
     """
-    tfms = get_base_transforms(config=config)
+    # random affine transforms are applied to the whole batch in the training loop, see `get_batch_transforms`
+    exclude = BATCHED_AFFINE_TRANSFORMS if _use_batched_affine(config) else ()
+    train_tfms = _get_stage_transforms(config, "train", exclude=exclude)
 
-    if "train" in config.transforms.keys():
-        tfm_names = list(config.transforms.train)
-        train_tfms = [get_transform(tn, config) for tn in tfm_names]
-        tfms += [tfm for tfm in train_tfms if tfm not in tfms]  # add rest
+    tfms = _prepend_base_transforms(config, train_tfms)
 
     # Concat multisequence data to single Tensors on the ChannelDim
     # Rename images to `CommonKeys.IMAGE` and labels to `CommonKeys.LABELS`
@@ -104,36 +764,103 @@ def get_train_transforms(config: munch.Munch) -> Compose:
 
     tfms += _concat_image_and_maybe_label(config)
 
-    return Compose(tfms)
+    return _compose(config, tfms)
+
+
+Range = Optional[Tuple[float, float]]
+
+
+def _axis_ranges(value, n_axes: int, offset: float = 0.0) -> List[Range]:
+    """Per-axis (min, max) ranges of a range argument of monai random transforms, such as `rotate_range`.
+    A number `v` gives the range (offset - v, offset + v), a pair the range (offset + min, offset + max).
+    Axes without a range are None, as in monai a single number only applies to the first axis.
+    """
+    ranges: List[Range] = [None] * n_axes
+    for i, v in enumerate(ensure_tuple(value)[:n_axes] if value is not None else ()):
+        if v is None:
+            continue
+        low, high = (float(v[0]), float(v[1])) if isinstance(v, (list, tuple)) else (-float(v), float(v))
+        ranges[i] = (offset + low, offset + high)
+    return ranges
+
+
+def _union(ranges: Sequence[List[Range]]) -> List[Range]:
+    """Per-axis union of ranges, so that each axis covers the ranges of all transforms"""
+    union: List[Range] = []
+    for axis_ranges in zip(*ranges):
+        configured = [r for r in axis_ranges if r is not None]
+        union.append((min(r[0] for r in configured), max(r[1] for r in configured)) if configured else None)
+    return union
+
+
+def _use_batched_affine(config: munch.Munch) -> bool:
+    train_config = config.transforms.get("train") or {}
+    return bool(config.transforms.get("batched_affine")) and any(tn in train_config for tn in BATCHED_AFFINE_TRANSFORMS)
+
+
+def get_batch_transforms(config: munch.Munch) -> Optional[BatchedAffine]:
+    """Transforms applied to the whole batch during training.
+    If `config.transforms.batched_affine` is set, rotation, scaling and translation ranges of
+    all random affine transforms in `config.transforms.train` are fused into a single `BatchedAffine`.
+    """
+    if not _use_batched_affine(config):
+        return None
+    train_config = config.transforms.train
+    tfm_configs = [train_config[tn] or {} for tn in BATCHED_AFFINE_TRANSFORMS if tn in train_config]
+    ndim = config.ndim
+    n_angles = 3 if ndim == 3 else 1
+
+    rotation = [_axis_ranges(c.get("rotate_range"), n_angles) for c in tfm_configs]
+    rotation += [
+        [_axis_ranges(c.get(k), 1)[0] for k in ["range_x", "range_y", "range_z"][:n_angles]] for c in tfm_configs
+    ]
+    scale = [_axis_ranges(c.get("scale_range"), ndim, offset=1.0) for c in tfm_configs]
+    if "RandZoomd" in train_config:
+        zoom_config = train_config.get("RandZoomd") or {}
+        min_zoom = ensure_tuple_rep(zoom_config.get("min_zoom", 0.9), ndim)
+        max_zoom = ensure_tuple_rep(zoom_config.get("max_zoom", 1.1), ndim)
+        scale.append([(float(low), float(high)) for low, high in zip(min_zoom, max_zoom)])
+    translation = [_axis_ranges(c.get("translate_range"), ndim) for c in tfm_configs]
+
+    # kornia orders axes as (x, y, z) = (W, H, D), the reverse of the spatial axes of monai.
+    # axes without a configured range are neither rotated nor scaled
+    degrees = [(math.degrees(r[0]), math.degrees(r[1])) if r else (0.0, 0.0) for r in reversed(_union(rotation))]
+    scales = [r or (1.0, 1.0) for r in reversed(_union(scale))]
+    # monai translates by voxels, kornia by fraction of the image size
+    translates = [
+        max(abs(r[0]), abs(r[1])) / size if r else 0.0
+        for r, size in zip(reversed(_union(translation)), reversed(config.input_size))
+    ]
+
+    return BatchedAffine(
+        ndim=ndim,
+        degrees=tuple(degrees) if ndim == 3 else degrees[0],
+        scale=(tuple(scales) if ndim == 3 else sum(scales, ())) if any(s != (1.0, 1.0) for s in scales) else None,
+        translate=tuple(translates) if any(translates) else None,
+        prob=max(c.get("prob", config.transforms.prob) for c in tfm_configs),
+        transform_label=config.task == "segmentation",
+    )
 
 
 def get_valid_transforms(config: munch.Munch) -> Compose:
     """Transforms applied only to the valid dataset"""
-    tfms = get_base_transforms(config=config)
-    tfms += [
-        get_transform("EnsureTyped", config=config, data_type="tensor"),
-    ]
-    if "valid" in config.transforms.keys():
-        tfm_names = list(config.transforms.valid)
-        tfms += [get_transform(tn, config) for tn in tfm_names]
+    valid_tfms = _get_stage_transforms(config, "valid", deterministic=True)
+    ensure_typed = get_transform("EnsureTyped", config=config, data_type="tensor")
+    tfms = _prepend_base_transforms(config, valid_tfms, after_base=[ensure_typed])
 
     tfms += _concat_image_and_maybe_label(config)
-    return Compose(tfms)
+    return _compose(config, tfms)
 
 
 def get_test_transforms(config: munch.Munch) -> Compose:
     """Transforms applied only to the test dataset"""
-    tfms = get_base_transforms(config=config)
-    tfms += [
-        get_transform("EnsureTyped", config=config, allow_missing_keys=True),
-    ]
-    if "test" in config.transforms.keys():
-        tfm_names = list(config.transforms.test)
-        tfms += [get_transform(tn, config) for tn in tfm_names]
+    test_tfms = _get_stage_transforms(config, "test", deterministic=True)
+    ensure_typed = get_transform("EnsureTyped", config=config, allow_missing_keys=True)
+    tfms = _prepend_base_transforms(config, test_tfms, after_base=[ensure_typed])
 
-    tfms += _concat_image_and_maybe_label(config)
+    tfms += _concat_image_and_maybe_label(config, allow_missing_labels=True)
 
-    return Compose(tfms)
+    return _compose(config, tfms)
 
 
 def get_post_transforms(config: munch.Munch):
@@ -145,12 +872,12 @@ def get_post_transforms(config: munch.Munch):
 
     tfms += [
         get_transform(
-            "AsDiscreted",
+            "OneHotd",
             config=config,
             keys=[CommonKeys.PRED, CommonKeys.LABEL],
             argmax=[True, False],
-            to_onehot=n_classes,
             num_classes=n_classes,
+            compile_kernel=config.transforms.get("compile_post_transforms", False),
         ),
     ]
 
@@ -4,7 +4,7 @@ import multiprocessing
 import resource
 import sys
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Sequence, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
 
 import monai
 import munch
@@ -137,3 +137,16 @@ def get_n_classes_of_model_from_config(config: munch.Munch) -> int:
             "Model dict has no attribute `out_channels` or `num_classes`. "
             "Cannot derive number of classes from model dict"
         )
+
+
+def get_memory_format(config: munch.Munch) -> Optional[torch.memory_format]:
+    """Memory format of images and network, if `config.transforms.channel_layout` is `channels_last`.
+    With channels last, the channels of each pixel/voxel are stored next to each other, which
+    allows faster convolutions on recent GPUs and CPUs.
+    """
+    channel_layout = config.transforms.get("channel_layout", "channels_first")
+    if channel_layout == "channels_first":
+        return None
+    elif channel_layout == "channels_last":
+        return torch.channels_last_3d if config.ndim == 3 else torch.channels_last
+    raise ValueError(f"Unknown channel_layout {channel_layout}. Use `channels_first` or `channels_last`")